@@ -1,21 +1,74 @@
 import xmlrpc.client as xc
 import ssl
-from datetime import datetime, timedelta
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+#Längere Zeiträume werden in Fenster dieser Größe aufgeteilt und parallel abgerufen
+TRANSACTION_WINDOW_DAYS = 31
+MAX_PARALLEL_WINDOWS = 4
+
+#SSL-Kontexte je Prüfmodus nur einmal je Prozess anlegen, das Laden der CA-Zertifikate ist teuer
+_SSL_CONTEXTS = {}
+
+def _get_ssl_context(ignore_cert):
+    context = _SSL_CONTEXTS.get(ignore_cert)
+    if context is None:
+        if ignore_cert:
+            context = ssl._create_unverified_context()
+        else:
+            context = ssl.create_default_context()
+        _SSL_CONTEXTS[ignore_cert] = context
+    return context
 
-  
 class Hibiscus():
 
     def __init__(self, server, port, master_password, ignore_cert = 0):
-        if ignore_cert == 1:
-            self.client = xc.Server("https://admin:" + master_password + "@" + server + ":" + port + "/xmlrpc", context=ssl._create_unverified_context())
-        else:
-            self.client = xc.Server("https://admin:" + master_password + "@" + server + ":" + port + "/xmlrpc")
+        self.context = _get_ssl_context(ignore_cert == 1)
+        self.url = "https://" + server + ":" + port + "/xmlrpc"
+        self.authorization = "Basic " + base64.b64encode(("admin:" + master_password).encode()).decode()
+        self._thread_clients = threading.local()
+        self.client = self.thread_client()
+
+    def _create_client(self):
+        #Basic-Auth als fertiger Header statt in der URL: das Passwort taucht so nicht in
+        #Fehlermeldungen mit der URL auf und wird nicht je Aufruf aus der URL gelesen und kodiert
+        return xc.Server(self.url, transport=xc.SafeTransport(context=self.context, headers=[("Authorization", self.authorization)]))
+
+    def thread_client(self):
+        #ServerProxy ist nicht threadsicher: je Thread ein eigener Client, der wiederverwendet wird
+        #und so die Verbindung offen hält; im anlegenden Thread ist das self.client
+        client = getattr(self._thread_clients, "client", None)
+        if client is None:
+            client = self._thread_clients.client = self._create_client()
+        return client
     
     def get_accounts(self):
         accounts = self.client.hibiscus.xmlrpc.konto.find()
         return accounts
 
     def get_transactions(self, id, datum_min=False, datum_max=False):
+        return self.thread_client().hibiscus.xmlrpc.umsatz.list(self._get_transaction_params(id, datum_min, datum_max))
+
+    def get_transactions_windowed(self, id, datum_min, datum_max):
+        #Zeitraum in aufeinanderfolgende, nicht überlappende Fenster aufteilen
+        windows = []
+        start = datum_min
+        while start <= datum_max:
+            end = min(start + timedelta(days=TRANSACTION_WINDOW_DAYS - 1), datum_max)
+            windows.append((start, end))
+            start = end + timedelta(days=1)
+        if len(windows) <= 1:
+            return self.get_transactions(id, datum_min, datum_max)
+
+        with ThreadPoolExecutor(max_workers=min(len(windows), MAX_PARALLEL_WINDOWS)) as executor:
+            transactions = []
+            for window_transactions in executor.map(lambda window: self.get_transactions(id, *window), windows):
+                transactions.extend(window_transactions)
+        return transactions
+
+    def _get_transaction_params(self, id, datum_min=False, datum_max=False):
         params = {
             "konto_id": id
             }
@@ -25,10 +78,9 @@ class Hibiscus():
             params["datum:max"] = datum_max.strftime("%d.%m.%Y")
         #Falls kein Datumsbereich ausgewählt wurde, laden wir die letzten 30 Tage
         if not datum_min and not datum_max:
-            datum_min = datetime.now() - timedelta(days=30)
+            datum_min = date.today() - timedelta(days=30)
             params["datum:min"] = datum_min.strftime("%d.%m.%Y")
-        transactions = self.client.hibiscus.xmlrpc.umsatz.list(params)
-        return transactions
+        return params
 
     def get_debit_charge(self,params):
         debit_charge = self.client.hibiscus.xmlrpc.sepalastschrift.create(params)
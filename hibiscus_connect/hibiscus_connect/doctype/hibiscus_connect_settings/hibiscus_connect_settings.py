@@ -3,12 +3,26 @@
 
 import frappe
 from frappe.model.document import Document
-import xmlrpc.client as xc
-import ssl
 from hibiscus_connect.hibclient import Hibiscus
 import pandas as pd
 from datetime import datetime
 
+# Spalten der CSV-Exportdatei, einmal beim Import des Moduls statt je Export angelegt
+EXPORT_COLUMNS = ("Bankleitzahl oder BIC des Kontoinhabers",
+	"Kontonummer oder IBAN des Kontoinhabers",
+	"Auszugsnummer",
+	"Auszugsdatum",
+	"Valuta",
+	"Buchungsdatum",
+	"Umsatz",
+	"Auftraggebername 1",
+	"Auftraggebername 2",
+	"Bankleitzahl oder BIC des Auftraggebers",
+	"Kontonummer oder IBAN des Auftraggebers",
+	"Verwendungszweck 1",
+)
+EXPORT_DATE_COLUMNS = ("Valuta", "Buchungsdatum")
+
 
 class HibiscusConnectSettings(Document):
 	@frappe.whitelist()
@@ -20,79 +34,49 @@ class HibiscusConnectSettings(Document):
 	@frappe.whitelist()
 	def get_export(self):
 		current_date = datetime.today().strftime('%d.%m.%Y')
-		columns = ["Bankleitzahl oder BIC des Kontoinhabers", 
-	     			"Kontonummer oder IBAN des Kontoinhabers", 
-					"Auszugsnummer", 
-					"Auszugsdatum",
-					"Valuta", 
-					"Buchungsdatum",
-					"Umsatz",
-					"Auftraggebername 1",
-					"Auftraggebername 2",
-					"Bankleitzahl oder BIC des Auftraggebers",
-					"Kontonummer oder IBAN des Auftraggebers",
-					"Verwendungszweck 1",
-					 ]
 		
+		#Zeilen als Tupel laden, die Exportzeile wird positionsweise aufgebaut
 		hib_data = frappe.get_all("Hibiscus Connect Transaction", filters = {"datum":["between", [self.from_date, self.to_date]],
-								       										"konto": self.export_konto})
+								       										"konto": self.export_konto},
+								fields = ["name", "valuta", "datum", "betrag", "empfaenger_name",
+										"empfaenger_blz", "empfaenger_konto", "zweck"], as_list=True)
 		print(len(hib_data))
+		# Eigene Bankverbindung und Auszugsdatum sind für alle Zeilen gleich
+		own_columns = [self.bic, self.export_konto, "", current_date]
 		exp_data = []
-		for x in hib_data:
-			el = frappe.get_doc("Hibiscus Connect Transaction",x.name)
-
-			print(el.empfaenger_name)
-			if el.empfaenger_name == "BFS finance GmbH":
-				print(True)
-				trans = el.name
-				bfs_trans = self.get_bfs_transaction(trans)
-				for el in bfs_trans:
-					exp_data.append(el)
+		for trans, valuta, datum, betrag, empfaenger_name, empfaenger_blz, empfaenger_konto, zweck in hib_data:
+			if empfaenger_name == "BFS finance GmbH":
+				exp_data.extend(self.get_bfs_transaction(trans, current_date, datum))
 			else:
-				print(False)
-				data =[self.bic,
-	   				self.export_konto , 
-					"",
-					current_date,
-					el.valuta,
-					el.datum,
-					el.betrag,
-					el.empfaenger_name,
+				data = own_columns + [
+					valuta,
+					datum,
+					betrag,
+					empfaenger_name,
 					"",
-					el.empfaenger_blz,
-					el.empfaenger_konto,
-					el.zweck,
+					empfaenger_blz,
+					empfaenger_konto,
+					zweck,
 					
 				]
 				exp_data.append(data)
-		print(exp_data)
-		print(len(exp_data))
-		df = pd.DataFrame(exp_data, columns=columns)
+		df = pd.DataFrame(exp_data, columns=list(EXPORT_COLUMNS))
 		df_sorted = df.sort_values(by="Buchungsdatum", ascending=True)
-		df_sorted['Valuta'] = df_sorted.apply(lambda x: x["Valuta"].strftime('%d.%m.%Y'), axis = 1)
-		df_sorted['Buchungsdatum'] = df_sorted.apply(lambda x: x['Buchungsdatum'].strftime('%d.%m.%Y'), axis = 1)
-		print(df.dtypes)
-		print(df_sorted)	
+		# Datumsspalten spaltenweise statt zeilenweise per apply formatieren
+		for date_column in EXPORT_DATE_COLUMNS:
+			df_sorted[date_column] = pd.to_datetime(df_sorted[date_column]).dt.strftime('%d.%m.%Y').fillna("")
 	
 		# # DataFrame als CSV-Datei speichern
 		# csv_data = df_sorted.to_csv(index=False, sep=';',decimal=',',header=False, line_terminator='\r\n', quoting=3)
 		# print(csv_data)
 		
 		# CSV-Datei mit den gewünschten Merkmalen manuell erstellen
-		csv_data = ""
-		for _, row in df_sorted.iterrows():
-			csv_row = []
-			for value in row.values:
-				if isinstance(value, str):
-					csv_row.append(f'"{value}"')
-				else:
-					a= str(value).replace(".", ",")
-					csv_row.append(a)
-			csv_data += ";".join(csv_row) + "\r\n"
+		# Werte spaltenweise formatieren statt je Zelle den Typ zu prüfen
+		csv_df = pd.DataFrame({column: format_csv_column(df_sorted[column]) for column in EXPORT_COLUMNS})
+		# Spalten mit str.cat spaltenweise zu Zeilen verbinden, dann alle Zeilen in einem Schritt zusammenfügen
+		lines = csv_df[EXPORT_COLUMNS[0]].str.cat([csv_df[column] for column in EXPORT_COLUMNS[1:]], sep=";")
+		csv_data = (lines + "\r\n").str.cat()
 
-		# CSV-Datei speichern
-		with open('data.csv', 'w', encoding='cp1252') as file:
-			file.write(csv_data)
 		name = "Bankdaten von "+ self.from_date +" bis " + self.to_date+".csv"
 		# #Datei in erpnext hochladen
 		file_data = frappe.get_doc({
@@ -107,24 +91,29 @@ class HibiscusConnectSettings(Document):
 
 
 
-	def get_bfs_transaction(self,trans):
-		bank_trans = frappe.get_doc("Hibiscus Connect Transaction", trans) 
-		date = bank_trans.datum
+	def get_bfs_transaction(self,trans, current_date=None, date=None):
+		if not current_date:
+			current_date = datetime.today().strftime('%d.%m.%Y')
+		# Buchungsdatum wird vom Export mitgegeben, sonst nur dieses Feld nachladen
+		if date is None:
+			date = frappe.db.get_value("Hibiscus Connect Transaction", trans, "datum")
 		#date = date_dt.strftime('%d.%m.%Y')
 
 
 		filters = {"hibiscus_connect_transaction":trans}
-		bfs_transaction_list = frappe.get_all("BFS List Item", filters=filters)
-		trans_list =[x.name for x in bfs_transaction_list]
-		print(bfs_transaction_list)
+		# Positionen und Lieferantennamen mit je einer Abfrage statt je Position laden
+		bfs_transaction_list = frappe.get_all("BFS List Item", filters=filters,
+										fields=["name", "supplier", "zahl_betrag", "belegnummer"])
+		supplier_names = {}
+		if bfs_transaction_list:
+			supplier_names = dict(frappe.get_all("Supplier",
+				filters={"name": ["in", list({x.supplier for x in bfs_transaction_list})]},
+				fields=["name", "supplier_name"], as_list=True))
+		own_columns = [self.bic, self.export_konto, "", current_date]
 		transactions =[]
-		for el in trans_list:
-			trans_doc = frappe.get_doc("BFS List Item",el)
-			supplier_name = frappe.get_doc("Supplier", trans_doc.supplier).supplier_name
-			transaction =[self.bic,
-		 			self.export_konto, 
-					"",
-					datetime.today().strftime('%d.%m.%Y'),
+		for trans_doc in bfs_transaction_list:
+			supplier_name = supplier_names[trans_doc.supplier]
+			transaction = own_columns + [
 					date,
 					date,
 					-trans_doc.zahl_betrag,
@@ -137,8 +126,11 @@ class HibiscusConnectSettings(Document):
 				]
 				
 			transactions.append(transaction)
-		print(transactions)
 		return(transactions)
 
-				
 
+def format_csv_column(column):
+	# Zahlenspalten mit Dezimalkomma, Texte in Anführungszeichen, sonstige Werte (z.B. None) als Text ohne Anführungszeichen
+	if pd.api.types.is_numeric_dtype(column):
+		return column.astype(str).str.replace(".", ",", regex=False)
+	return column.map(lambda value: f'"{value}"' if isinstance(value, str) else str(value).replace(".", ","))
@@ -1,8 +1,14 @@
 # Copyright (c) 2021, itsdave GmbH and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 class HibiscusConnectTransaction(Document):
 	pass
+
+def on_doctype_update():
+	# match_all_payments: status = "neu" und betrag > 0
+	frappe.db.add_index("Hibiscus Connect Transaction", ["status", "betrag"])
+	# Export: konto und datum between
+	frappe.db.add_index("Hibiscus Connect Transaction", ["konto", "datum"])
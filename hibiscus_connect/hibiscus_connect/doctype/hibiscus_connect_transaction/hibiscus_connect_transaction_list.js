@@ -12,12 +12,16 @@ frappe.listview_settings['Hibiscus Connect Transaction'] = {
         }
     },
 	onload: function(listview) {
+		// Verbuchung läuft im Hintergrund, nach Abschluss wird die Liste neu geladen
+		frappe.realtime.off("hibiscus_connect_matching_done");
+		frappe.realtime.on("hibiscus_connect_matching_done", function() {
+			listview.refresh();
+		});
 		listview.page.add_button(__("Zahlungen Verbuchen"), function() {
 			frappe.call({
 				method:'hibiscus_connect.tools.match_all_payments',
 				callback: function(r) {
 					frappe.msgprint(r.message);
-					listview.refresh();
 				}
 			});
 		}, "Aktionen");
@@ -7,11 +7,10 @@ from frappe.model.document import Document
 class SEPALastschriftMandat(Document):
 	@frappe.whitelist()
 	def get_creditor_from_settings(self):
-		settings = frappe.get_single("Hibiscus Connect Settings")
-		konto = settings.konto
-		kontoid = settings.konto_id
-		creditorid = settings.creditorid
-		return [konto,kontoid,creditorid]
+		#Nur die drei benötigten Felder statt des ganzen Settings-Dokuments laden
+		#Bei Single-Doctypes kommt die Reihenfolge nicht aus der Feldliste, daher über den Feldnamen lesen
+		settings = frappe.db.get_value("Hibiscus Connect Settings", None, ["konto", "konto_id", "creditorid"], as_dict=True) or {}
+		return [settings.get("konto"), settings.get("konto_id"), settings.get("creditorid")]
 		
 	#@frappe.whitelist()
 	def on_update(self):
@@ -23,16 +22,9 @@ class SEPALastschriftMandat(Document):
 
 	def get_mandat_nr(self):
 		customer = self.customer
-		sepa_cust = frappe.get_all("SEPA Lastschrift Mandat", filters= {"customer": customer})
-		count = len(sepa_cust)
-		if count != 0:
-			nächste_nr = count
-			if len(str(nächste_nr)) == 1:
-				return str(0) + str(nächste_nr)
-			else:
-				return str(nächste_nr)
-		else:
-			return str("01")
+		count = frappe.db.count("SEPA Lastschrift Mandat", filters= {"customer": customer})
+		nächste_nr = count or 1
+		return f"{nächste_nr:02d}"
 
 	# def get_mandateid(self, customer):
 		
@@ -42,3 +34,7 @@ class SEPALastschriftMandat(Document):
 #         	mandat_list.push(int(el.rsplit(„-„,1)[1]))
 #             if mandat_list:
 # 			nächste_nr = max(mandat_list) + 1
+
+def on_doctype_update():
+	# create_debit_charge sucht das aktive Mandat je Kunde, get_mandat_nr zählt je Kunde
+	frappe.db.add_index("SEPA Lastschrift Mandat", ["customer", "status"])
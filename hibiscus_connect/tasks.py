@@ -1,15 +1,57 @@
 import frappe
-from hibiscus_connect.tools import get_transactions_for_account
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from hibiscus_connect.tools import get_hibiscus_client, store_transactions_for_account
+
+#Maximale Anzahl gleichzeitiger Abrufe beim Hibiscus Server
+MAX_PARALLEL_FETCHES = 4
 
 def fetch_transactions_from_active_accounts():
     print("starte Umsatzabruf")
     accounts = frappe.get_all("Hibiscus Connect Bank Account", filters={
         "fetch_periodically": 1
-    })
+    }, fields=["name", "id", "erpnext_bankkonto"])
+    #Nicht verknüpfte Konten überspringen, statt den Abruf aller Konten abzubrechen
+    for account in accounts:
+        if not account["erpnext_bankkonto"]:
+            print("überspringe account " + str(account["name"]) + ": kein ERPNext Bankkonto verknüpft")
+    accounts = [account for account in accounts if account["erpnext_bankkonto"]]
     if accounts:
-        for account in accounts:
+        #Datumswerte statt Zeitstempel, wie in get_transactions_for_account
+        bis = date.today()
+        von = bis - timedelta(30)
+
+        #Hibiscus.get_transactions verwendet je Thread einen eigenen XML-RPC Client
+        hib = get_hibiscus_client()
+
+        def fetch(account):
+            #Nur Netzwerkzugriff, keine Datenbank
+            #Fehler je Konto zurückgeben, damit ein fehlgeschlagener Abruf die anderen Konten nicht verwirft;
+            #protokolliert wird im Haupt-Thread, da nur dieser Datenbankzugriff hat
+            try:
+                return hib.get_transactions(account["id"], von, bis), None
+            except Exception:
+                return None, traceback.format_exc()
+
+        #Die Abrufe beim Hibiscus Server sind unabhängig voneinander und laufen parallel,
+        #das Anlegen der Umsätze erfolgt danach nacheinander im Haupt-Thread
+        with ThreadPoolExecutor(max_workers=min(len(accounts), MAX_PARALLEL_FETCHES)) as executor:
+            fetched = list(executor.map(fetch, accounts))
+
+        for account, (transactions, error) in zip(accounts, fetched):
+            if error:
+                frappe.log_error(title="Hibiscus Connect: Umsatzabruf für " + str(account["name"]) + " fehlgeschlagen", message=error)
+                continue
             print("verarbeite account " + str(account["name"]))
-            get_transactions_for_account(account["name"])
+            #Savepoint je Konto: ein Fehler beim Speichern verwirft nur die Umsätze dieses Kontos
+            frappe.db.savepoint("hibiscus_connect_fetch")
+            try:
+                store_transactions_for_account(transactions, account["name"])
+            except Exception:
+                frappe.db.rollback(save_point="hibiscus_connect_fetch")
+                frappe.log_error(title="Hibiscus Connect: Speichern der Umsätze für " + str(account["name"]) + " fehlgeschlagen", message=frappe.get_traceback())
+        #Ein Commit für den gesamten Abruf statt je Konto
+        frappe.db.commit()
     else:
         print("keine Accounts für Abruf gefunden")
-
@@ -1,27 +1,52 @@
-from cmath import e
 #from ctypes.wintypes import HINSTANCE
-from attr import fields, ib
-from erpnext.accounts.doctype import account
 import frappe
 from hibiscus_connect.hibclient import Hibiscus
 import json
 from pprint import pprint
-from datetime import datetime as dt
 from datetime import date, timedelta
-from frappe.model.naming import set_name_by_naming_series, get_default_naming_series
+from frappe.model.naming import get_default_naming_series
+from frappe.utils import flt, getdate
 import re
-from pprint import pprint
-from numpy import append
-from pyparsing import Regex
-from frappe.exceptions import DuplicateEntryError, ValidationError
+from functools import lru_cache
+
+#Hibiscus liefert Beträge im deutschen Format ("1.234,56"): Tausenderpunkt entfernen, Komma zu Punkt
+_AMOUNT_TRANSLATION = str.maketrans({".": None, ",": "."})
+
+def _parse_amount(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    return float(value.translate(_AMOUNT_TRANSLATION))
+
+#Zuordnungsarten aus match_payment mit Bezeichnung für die Rückmeldung
+MATCH_TYPES = (
+    ("sinvs_matched_strict", "strict"),
+    ("sinvs_matched_loose", "loose"),
+    ("sinvs_matched_cust", "Kunde"),
+)
+
+#Payment Entry Nummer aus dem Altbestand im Kommentar einer Transaktion
+LEGACY_PAYMENT_ENTRY_REGEX = re.compile("PE-\\d\\d\\d\\d\\d")
+
+#Zahlungsbedingungen, bei denen create_debit_charge eine Lastschrift erzeugt
+SEPA_PAYMENT_TERMS = frozenset(("SEPA Einzug 7 Tage", "SEPA Einzug 14 Tage"))
+
+#Fester Job-Name, damit match_all_payments nur einmal gleichzeitig eingereiht wird
+MATCH_ALL_PAYMENTS_JOB_ID = "hibiscus_connect_match_all_payments"
+
+def get_hibiscus_client():
+    #XML-RPC Client aus den Hibiscus Connect Settings, wird für die Dauer des Requests/Jobs wiederverwendet
+    client = getattr(frappe.local, "hibiscus_client", None)
+    if client is None:
+        settings = frappe.get_single("Hibiscus Connect Settings")
+        client = Hibiscus(settings.server, settings.port, settings.get_password("hibiscus_master_password"), settings.ignore_cert)
+        frappe.local.hibiscus_client = client
+    return client
 
 @frappe.whitelist()
 
 def get_accounts_from_hibiscus_server():
     #Liefert ungefiltert alle Konten mit sämmtlichen Paramatern zurück
-    settings = frappe.get_single("Hibiscus Connect Settings")
-    hib = Hibiscus(settings.server, settings.port, settings.get_password("hibiscus_master_password") , settings.ignore_cert)
-    return hib.get_accounts()
+    return get_hibiscus_client().get_accounts()
 
 @frappe.whitelist()
 
@@ -45,37 +70,49 @@ def get_accounts_from_hibiscus_server_for_dialog():
 def create_accounts(dialog_accounts):
     hibiscus_accounts = get_accounts_from_hibiscus_server()
     dialog_accounts_dict = json.loads(dialog_accounts)
+    hibiscus_accounts_by_iban = {}
+    for hib_acc in hibiscus_accounts:
+        hibiscus_accounts_by_iban.setdefault(hib_acc["iban"], []).append(hib_acc)
     for key in dialog_accounts_dict:
         if dialog_accounts_dict[key] == 1:
-            iban_account_to_create = key
-            for hib_acc in hibiscus_accounts:
-                if hib_acc["iban"] == iban_account_to_create:
-                    create_hibiscus_connect_bank_account(hib_acc)
+            for hib_acc in hibiscus_accounts_by_iban.get(key, []):
+                create_hibiscus_connect_bank_account(hib_acc)
 
 def create_hibiscus_connect_bank_account(hib_acc):
     hib_acc["doctype"] = "Hibiscus Connect Bank Account"
     hib_acc["name1"] = hib_acc.pop("name")
-    hib_acc["saldo_available"] = float(str(hib_acc["saldo_available"]).replace(".","").replace(",","."))
-    hib_acc["saldo"] = float(str(hib_acc["saldo"]).replace(".","").replace(",","."))
+    hib_acc["saldo_available"] = _parse_amount(hib_acc["saldo_available"])
+    hib_acc["saldo"] = _parse_amount(hib_acc["saldo"])
     hib_acc_doc = frappe.get_doc(hib_acc)
     hib_acc_doc.save()
 
 @frappe.whitelist()
 
-def get_transactions_for_account(account, von = str(date.today()-timedelta(30)), bis = str(date.today())):
-    settings = frappe.get_single("Hibiscus Connect Settings")
-    hib = Hibiscus(settings.server, settings.port, settings.get_password("hibiscus_master_password"), settings.ignore_cert)
-
+def get_transactions_for_account(account, von = None, bis = None):
     account_doc = frappe.get_doc("Hibiscus Connect Bank Account", account)
     if not account_doc.erpnext_bankkonto:
         frappe.throw("Bitte Hibiscus Connect Bank Account mit ERPNext Bankkonto verknüpfen.")
+    #Verbindung erst aufbauen, wenn das Konto verwendbar ist
+    hib = get_hibiscus_client()
     
-    von_dt = dt.strptime (von,"%Y-%m-%d")
-    bis_dt = dt.strptime (bis,"%Y-%m-%d")
+    #Standardzeitraum erst beim Aufruf bestimmen, nicht beim Import des Moduls
+    von_dt = getdate(von) if von else date.today() - timedelta(30)
+    bis_dt = getdate(bis) if bis else date.today()
         
-    transactions = hib.get_transactions(account_doc.id, von_dt,bis_dt)  
-    check_trans_id = frappe.get_all("Hibiscus Connect Transaction", fields = "id")
-    check_trans_id_list = [ x["id"] for x in check_trans_id]
+    #Lange Zeiträume werden in mehreren parallelen Abrufen geladen
+    transactions = hib.get_transactions_windowed(account_doc.id, von_dt, bis_dt)
+    store_transactions_for_account(transactions, account)
+    frappe.db.commit()
+
+def store_transactions_for_account(transactions, account):
+    #Legt die von Hibiscus gelieferten Umsätze an, sofern noch nicht vorhanden.
+    #Der Commit erfolgt beim Aufrufer, damit Sammelabrufe nur einmal committen.
+    if not transactions:
+        return
+    #Nur die gelieferten IDs prüfen statt alle Umsätze zu laden; Hibiscus IDs sind global eindeutig
+    check_trans_id_list = set(frappe.get_all("Hibiscus Connect Transaction", filters={
+        "id": ["in", [hib_trans["id"] for hib_trans in transactions]]
+        }, pluck="id"))
     
     for hib_trans in transactions:
         if hib_trans["saldo"] != "0.0":
@@ -84,13 +121,12 @@ def get_transactions_for_account(account, von = str(date.today()-timedelta(30)),
                 create_hibiscus_connect_transaction(hib_trans, account)
         else:
             print(hib_trans)
-    frappe.db.commit()
 
 def create_hibiscus_connect_transaction(hib_trans, account):
     
     hib_trans["doctype"] = "Hibiscus Connect Transaction"
     hib_trans["saldo"] = float(str(hib_trans["saldo"]))
-    hib_trans["betrag"] = float(str(hib_trans["betrag"]).replace(".","").replace(",","."))
+    hib_trans["betrag"] = _parse_amount(hib_trans["betrag"])
     hib_trans["zweck_raw"] = hib_trans["zweck"]
     hib_trans_doc = frappe.get_doc(hib_trans)
     hib_trans_doc.konto = account
@@ -98,27 +134,22 @@ def create_hibiscus_connect_transaction(hib_trans, account):
 
 @frappe.whitelist()
 def match_hibiscus_transaction(hib_trans):
-    payments = frappe.get_all("Hibiscus Connect Transaction", filters={
-        "name": hib_trans
-    }, fields = ["name", "empfaenger_blz", "empfaenger_konto"])
-    hib_trans = payments[0]
+    hib_trans = frappe.db.get_value("Hibiscus Connect Transaction", hib_trans,
+        ["name", "empfaenger_blz", "empfaenger_konto"], as_dict=True)
     result = match_payment(hib_trans)
-    if result["sinvs_matched_strict"]:
-        pe = make_payment_entry(result)
-        create_bank_account_for_customer(pe.party, hib_trans["empfaenger_konto"], hib_trans["empfaenger_blz"])
-        return "Erfolgreich verbucht strict"
-    if result["sinvs_matched_loose"]:
-        pe = make_payment_entry(result)
-        create_bank_account_for_customer(pe.party, hib_trans["empfaenger_konto"], hib_trans["empfaenger_blz"])
-        return "Erfolgreich verbucht loose"
-    if result["sinvs_matched_cust"]:
-        pe = make_payment_entry(result)
-        create_bank_account_for_customer(pe.party, hib_trans["empfaenger_konto"], hib_trans["empfaenger_blz"])
-        return "Erfolgreich verbucht Kunde"
+    for match_type, label in MATCH_TYPES:
+        if result[match_type]:
+            _book_matched_payment(result, hib_trans)
+            return "Erfolgreich verbucht " + label
     frappe.throw("Zahlung konnte nicht automatisiert verbucht werden.<br>" + str(result))
+
+def _book_matched_payment(result, hib_trans, settings=None):
+    pe = make_payment_entry(result, settings=settings)
+    create_bank_account_for_customer(pe.party, hib_trans["empfaenger_konto"], hib_trans["empfaenger_blz"])
+    return pe
     
 
-def match_payment(hib_trans, sinvs=None, sinv_names=None):
+def match_payment(hib_trans, sinvs=None, sinv_names=None, customers=None, sinvs_by_customer=None):
     hib_trans_doc = frappe.get_doc("Hibiscus Connect Transaction", hib_trans)
     matching_list = {
         "sinvs_matched_strict": False,
@@ -128,17 +159,17 @@ def match_payment(hib_trans, sinvs=None, sinv_names=None):
         "betrag": hib_trans_doc.betrag,
         "zweck": hib_trans_doc.zweck,
         "account": hib_trans_doc.konto,
-        "erpnext_bankkonto": frappe.get_doc("Hibiscus Connect Bank Account", hib_trans_doc.konto),
+        "erpnext_bankkonto": frappe.get_cached_value("Hibiscus Connect Bank Account", hib_trans_doc.konto, "erpnext_bankkonto"), #nur das verknüpfte Konto wird benötigt
         "hib_trans_doc": hib_trans_doc,
         "sinvs": [],
         "sinvs_loose": [],
         "cust": "", #Zuordnung der Transaktion zu einem Kunden
         "sinvs_cust": []
         }
-    if not sinvs:
-        sinvs = _get_unpaid_sinv_numbers()
     if not sinv_names:
         sinv_names = _get_unpaid_sinv_names()
+    if not sinvs:
+        sinvs = _get_unpaid_sinv_numbers(sinv_names)
     #Kriterien, die zum verbuchen herangezogen werden:
     #1.) Zweck enthällt mindesten eine Rechnungsnummer einer unbezahlten Rechnung im vollständigen format
     matching_list["sinvs"] = _get_sinv_names(hib_trans_doc.zweck, sinvs)
@@ -165,29 +196,77 @@ def match_payment(hib_trans, sinvs=None, sinv_names=None):
 
     #3.1) Zweck enthällt eine Kundenummer einer unbezahlten Rechnung (auch ohne Naming Series Prefix)
     if matching_list["cust"] == "":
-        matching_list["cust"] = _cust_match(hib_trans_doc.zweck, sinv_names)
+        matching_list["cust"] = _cust_match(hib_trans_doc.zweck, sinv_names, customers)
 
     #3.2) Die Bankverbindung ist einem Kunden zugeordnet
-    if matching_list["cust"] == "" or not matching_list["cust"]:
-        acc = frappe.get_all("Bank Account", filters={"iban": hib_trans_doc.empfaenger_konto }, fields=["party"])
-        if acc:
-            matching_list["cust"] = acc[0]["party"]
-
-    if matching_list["cust"] != "":
+    #Ohne Bankverbindung der Gegenseite gibt es nichts nachzuschlagen
+    if not matching_list["cust"] and hib_trans_doc.empfaenger_konto:
+        party = _get_party_for_iban(hib_trans_doc.empfaenger_konto)
+        if party:
+            matching_list["cust"] = party
+
+    #_cust_match liefert False, wenn kein Kunde gefunden wurde
+    if matching_list["cust"]:
         #3.3 Rechnunen ermitteln, deren Summe dem Betrag entspricht.
-        matching_list["sinvs_cust"] = find_matching_invoices_for_customer_payment(hib_trans_doc, sinv_names, matching_list["cust"])
-        print(matching_list["sinvs_cust"])
+        matching_list["sinvs_cust"] = find_matching_invoices_for_customer_payment(hib_trans_doc, sinv_names, matching_list["cust"], sinvs_by_customer)
         if matching_list["sinvs_cust"]:
             matching_list["sinvs_matched_cust"] = True
             matching_list["totals_matched"] = True
-            print("183 ", matching_list)
             return matching_list
     return matching_list
 
     
     
+def _get_party_for_iban(iban):
+    #Gefundene Kunden je Bankverbindung für den Request/Job merken, zahlt ein Kunde mehrfach, entfällt die Abfrage.
+    #Nur Treffer merken: während des Laufs angelegte Bankkonten sollen weiterhin gefunden werden
+    parties = getattr(frappe.local, "hibiscus_iban_parties", None)
+    if parties is None:
+        parties = frappe.local.hibiscus_iban_parties = {}
+    party = parties.get(iban)
+    if not party:
+        party = frappe.db.get_value("Bank Account", {"iban": iban}, "party")
+        if party:
+            parties[iban] = party
+    return party
+
 @frappe.whitelist()
-def match_all_payments(von = str(date.today()-timedelta(30)), bis = str(date.today())):
+def match_all_payments(von = None, bis = None):
+    #Verbuchung als Hintergrundjob, damit der Request bei vielen Zahlungen nicht in den Timeout läuft.
+    #Bewusst ein einzelner Job: parallele Teiljobs könnten dieselbe Rechnung mehrfach zuordnen.
+    #Aus demselben Grund wird kein zweiter Lauf gestartet, solange einer wartet oder läuft.
+    job = frappe.enqueue(
+        "hibiscus_connect.tools.match_all_payments_job",
+        queue="long",
+        timeout=3600,
+        job_id=MATCH_ALL_PAYMENTS_JOB_ID,
+        deduplicate=True,
+        user=frappe.session.user,
+    )
+    if not job:
+        return "Die Zahlungseingänge werden bereits verarbeitet. Das Ergebnis wird nach Abschluss angezeigt."
+    return "Die Zahlungseingänge werden im Hintergrund verarbeitet. Das Ergebnis wird nach Abschluss angezeigt."
+
+def match_all_payments_job(user=None):
+    user = user or frappe.session.user
+    try:
+        html = _match_all_payments()
+    except Exception:
+        #Wie beim früheren synchronen Aufruf wird der gesamte Lauf zurückgerollt,
+        #der Benutzer erfährt davon über die Meldung statt eines stillen Jobfehlers
+        frappe.db.rollback()
+        frappe.log_error(title="Hibiscus Connect: Zahlungen verbuchen abgebrochen")
+        html = "<h2>Verbuchung abgebrochen</h2><p>Es wurden keine Zahlungen verbucht. Details im Error Log.</p>"
+    #Meldungen aus make_payment_entry gehen im Hintergrundjob sonst verloren
+    messages = [json.loads(m) if isinstance(m, str) else m for m in frappe.local.message_log]
+    for m in messages:
+        html += "<hr>" + str(m.get("message", ""))
+    #Erst nach dem Commit des Jobs senden, sonst lädt die Liste noch den alten Stand
+    frappe.publish_realtime("msgprint", html, user=user, after_commit=True)
+    #Listenansicht aktualisiert sich auf dieses Ereignis, statt nachzufragen
+    frappe.publish_realtime("hibiscus_connect_matching_done", user=user, after_commit=True)
+
+def _match_all_payments():
     stats = {
         "sinvs_matched_strict": 0,
         "sinvs_matched_loose": 0,
@@ -199,54 +278,97 @@ def match_all_payments(von = str(date.today()-timedelta(30)), bis = str(date.tod
         "status": "neu",
         "betrag": [">", 0],
     }, fields = ["name", "empfaenger_blz", "empfaenger_konto"])
-
-    unpaid_sinvs = _get_unpaid_sinv_numbers()
+    #Ohne neue Zahlungseingänge keine Rechnungen und Einstellungen laden
+    if not payments:
+        return get_text_from_stats(stats)
+
+    unpaid_sinv_names = _get_unpaid_sinv_names()
+    unpaid_sinvs = _get_unpaid_sinv_numbers(unpaid_sinv_names)
+    #Offene Rechnungen je Kunde einmal je Lauf laden statt je Zahlung in _cust_match
+    #und find_matching_invoices_for_customer_payment abzufragen
+    unpaid_sinvs_by_customer = _get_unpaid_sinvs_by_customer(unpaid_sinv_names)
+    #Reihenfolge der Kundenliste bestimmt, welche Kundennummer im Muster zuerst greift (z.B. kd-1 vs. kd-10),
+    #daher wie in _cust_match aus _get_unpaid_sinv_customers und nicht aus dem Index
+    unpaid_customers = _get_unpaid_sinv_customers(unpaid_sinv_names)
+    #Einstellungen einmal für den gesamten Lauf laden statt je Zahlung in make_payment_entry
+    settings = frappe.get_single("Hibiscus Connect Settings")
     payments_list = []
+    #Fortschritt nur in ca. 2%-Schritten senden statt nach jeder Zahlung
+    total = len(payments)
+    progress_interval = max(1, total // 50)
 
     count = 0
     for p in payments:
         count += 1
         payments_list.append(p)
-        result = match_payment(p.name, sinvs=unpaid_sinvs)
+        result = match_payment(p.name, sinvs=unpaid_sinvs, sinv_names=unpaid_sinv_names, customers=unpaid_customers, sinvs_by_customer=unpaid_sinvs_by_customer)
         
         stats["payments_processed"] += 1
-        if result["sinvs_matched_strict"]:
-            stats["sinvs_matched_strict"] += 1
-            pe = make_payment_entry(result)
-            create_bank_account_for_customer(pe.party, p["empfaenger_konto"], p["empfaenger_blz"])
-        if result["sinvs_matched_loose"]:
-            stats["sinvs_matched_loose"] += 1
-            pe = make_payment_entry(result)
-            create_bank_account_for_customer(pe.party, p["empfaenger_konto"], p["empfaenger_blz"])
-        if result["sinvs_matched_cust"]:
-            stats["sinvs_matched_cust"] += 1
-            print(result)
-            pe = make_payment_entry(result)
-            create_bank_account_for_customer(pe.party, p["empfaenger_konto"], p["empfaenger_blz"])
+        #match_payment setzt höchstens eine der Zuordnungsarten
+        for match_type, label in MATCH_TYPES:
+            if result[match_type]:
+                stats[match_type] += 1
+                _book_matched_payment(result, p, settings)
+                #Durch die Buchung bezahlte Rechnungen aus den offenen Rechnungen des Laufs entfernen,
+                #sonst würden sie weiteren Zahlungen erneut zugeordnet
+                paid_sinvs = _get_paid_sinvs(result)
+                if paid_sinvs:
+                    unpaid_sinv_names = [name for name in unpaid_sinv_names if name not in paid_sinvs]
+                    unpaid_sinvs = _get_unpaid_sinv_numbers(unpaid_sinv_names)
+                    _remove_sinvs_from_customer_index(unpaid_sinvs_by_customer, paid_sinvs)
+                    unpaid_customers = [customer for customer in unpaid_customers if customer in unpaid_sinvs_by_customer]
+                break
         if result["totals_matched"]:
             stats["totals_matched"] += 1
         else:
             debug_data(result)
         
-        frappe.publish_progress(
-			count * 100 / len(payments),
-			title="Verarbeite Zahlungseingänge...",
-		)
+        if count % progress_interval == 0 or count == total:
+            frappe.publish_progress(
+                count * 100 / total,
+                title="Verarbeite Zahlungseingänge...",
+            )
     
     pprint(stats)
     return get_text_from_stats(stats)
 
+def _get_paid_sinvs(result):
+    #Zugeordnete Rechnungen, die nach der Buchung nicht mehr offen sind
+    candidates = set(result["sinvs"]).union(result["sinvs_loose"], result["sinvs_cust"])
+    if not candidates:
+        return set()
+    still_unpaid = frappe.get_all("Sales Invoice", filters={
+        "name": ["in", list(candidates)],
+        "status": ["not in", ["Return", "Paid"]]
+        }, pluck="name")
+    return candidates.difference(still_unpaid)
+
+def _remove_sinvs_from_customer_index(sinvs_by_customer, sinv_names):
+    for customer in list(sinvs_by_customer):
+        remaining = [sinv for sinv in sinvs_by_customer[customer] if sinv["name"] not in sinv_names]
+        if remaining:
+            sinvs_by_customer[customer] = remaining
+        else:
+            del sinvs_by_customer[customer]
+
 def debug_data(result):
     print("--------------------")
     print(result["zweck"])
     print(result["betrag"])
    
 
+@lru_cache(maxsize=8)
+def _get_alternation_regex(candidates):
+    #Rechnungs- bzw. Kundennummern als Literale (maskiert) in ein Muster übernehmen,
+    #im Sammellauf ist die Kandidatenliste gleich und wird nur einmal kompiliert
+    return re.compile("|".join(re.escape(candidate) for candidate in candidates))
+
 def _advanced_si_match(zweck, sinvs):
     si_list = []
-    regex = "|".join(sinvs)
+    if not sinvs or not zweck:
+        return si_list
     zweck = zweck.replace(" ","")
-    match_regex_naming_series =re.findall(regex, zweck)
+    match_regex_naming_series = _get_alternation_regex(tuple(sinvs)).findall(zweck)
     if match_regex_naming_series:
         for m in match_regex_naming_series:
             sinv_name = "SINV-" + str(m)
@@ -254,21 +376,32 @@ def _advanced_si_match(zweck, sinvs):
                 si_list.append(sinv_name)
     return si_list
 
-def _cust_match(zweck, sinvs):
-    si_list = []
-    cust_list = []
-    sinv_doc_list = frappe.get_all("Sales Invoice", filters={
+def _get_unpaid_sinv_customers(sinvs):
+    customers = frappe.get_all("Sales Invoice", filters={
         "name": ["in", sinvs]
-    }, fields=[
-        "name", "customer"
-    ])
-    for sinv_el in sinv_doc_list:
-        if str(sinv_el["customer"]).lower() not in cust_list:
-            cust_list.append(str(sinv_el["customer"]).lower())
-    regex = "|".join(cust_list)
+    }, pluck="customer")
+    #Reihenfolge beibehalten, Duplikate entfernen
+    return list(dict.fromkeys(str(customer).lower() for customer in customers))
+
+def _get_unpaid_sinvs_by_customer(sinvs):
+    sinvs_by_customer = {}
+    for sinv in frappe.get_all("Sales Invoice", filters={
+        "name": ["in", sinvs]
+    }, fields=["name", "customer", "grand_total"], order_by="name asc"):
+        sinvs_by_customer.setdefault(str(sinv["customer"]).lower(), []).append(sinv)
+    return sinvs_by_customer
+
+def _cust_match(zweck, sinvs, cust_list=None):
+    #Ohne Verwendungszweck gibt es nichts zu suchen, Rechnungsabfrage sparen
+    if not zweck:
+        return False
+    if cust_list is None:
+        cust_list = _get_unpaid_sinv_customers(sinvs)
+    if not cust_list:
+        return False
     zweck = zweck.replace(" ","")
     zweck = str(zweck).lower()
-    match_regex_customer =re.findall(regex, zweck)
+    match_regex_customer = _get_alternation_regex(tuple(cust_list)).findall(zweck)
     if match_regex_customer:
         if len(match_regex_customer) > 1:
             frappe.throw("Mehr als eine Kundenummern im Verwendungszweck gefunden.")
@@ -277,23 +410,31 @@ def _cust_match(zweck, sinvs):
         return False
 
 
-def find_matching_invoices_for_customer_payment(hib_trans_doc, sinv_names, customer):
-    sinv_doc_list = frappe.get_all("Sales Invoice", filters={
-        "name": ["in", sinv_names],
-        "grand_total": ["<=", float(hib_trans_doc.betrag)],
-        "customer": customer
-    }, fields=[
-        "name", "customer", "grand_total"
-    ], order_by="name asc")
+def find_matching_invoices_for_customer_payment(hib_trans_doc, sinv_names, customer, sinvs_by_customer=None):
+    if sinvs_by_customer is None:
+        sinv_doc_list = frappe.get_all("Sales Invoice", filters={
+            "name": ["in", sinv_names],
+            "grand_total": ["<=", float(hib_trans_doc.betrag)],
+            "customer": customer
+        }, fields=[
+            "name", "customer", "grand_total"
+        ], order_by="name asc")
+    else:
+        #Vorab geladene Rechnungen des Kunden verwenden, Kunde wie in der Datenbank ohne Groß-/Kleinschreibung
+        sinv_doc_list = [sinv for sinv in sinvs_by_customer.get(str(customer).lower(), [])
+            if sinv["grand_total"] <= float(hib_trans_doc.betrag)]
     #Prüfen, ob die offenen Rechungsbeträge in irgendeiner Kombination dem Zahlbetrag entsprechen
     combined_totals = combine_totals(hib_trans_doc.betrag, sinv_doc_list)
     matched_sinvs = []
     if combined_totals:
+        #Rechnungen einmal nach Betrag gruppieren statt je Teilbetrag alle Rechnungen zu durchlaufen
+        sinvs_by_total = {}
+        for sinv in sinv_doc_list:
+            sinvs_by_total.setdefault(sinv["grand_total"], []).append(sinv["name"])
         for ct in combined_totals:
-            for sinv in sinv_doc_list:
-                if ct == sinv["grand_total"]:
-                    if sinv["name"] not in matched_sinvs:
-                        matched_sinvs.append(sinv["name"])
+            for sinv_name in sinvs_by_total.get(ct, []):
+                if sinv_name not in matched_sinvs:
+                    matched_sinvs.append(sinv_name)
     
     return matched_sinvs
 
@@ -311,18 +452,19 @@ def combine_totals(sum, sinvs): #gibt ggf. eine Liste an Beträgen zurück, die
         return None
 
 #stolen from https://stackoverflow.com/questions/34517540/find-all-combinations-of-a-list-of-numbers-with-a-given-sum  and adapted afterwards  
-def subset_sum(numbers, target, partial=[]): #Ermittelt mögliche Kombinatiinen der Rechnungssummen
-    s = sum(partial)
+def subset_sum(numbers, target, partial=None, partial_sum=0, start=0): #Ermittelt mögliche Kombinatiinen der Rechnungssummen
+    # partial_sum wird mitgeführt statt sum(partial) je Aufruf, start ersetzt das Kopieren der Restliste
+    if partial is None:
+        partial = []
     # check if the partial sum is equals to target
-    if round(s,3) == target:
+    if round(partial_sum,3) == target:
         print("sum(%s)=%s" % (partial, target))
         return partial
-    if s > target:
+    if partial_sum > target:
         return # if we reach the number why bother to continue
-    for i in range(len(numbers)):
+    for i in range(start, len(numbers)):
         n = numbers[i]
-        remaining = numbers[i + 1:]
-        result = subset_sum(remaining, target, partial + [n])
+        result = subset_sum(numbers, target, partial + [n], partial_sum + n, i + 1)
         if result:
             return result
 
@@ -330,38 +472,49 @@ def get_sinvs_for_matched_totals(totals, sinvs):
     pass
 
 
-def _get_unpaid_sinv_numbers():
-    sinv_numbers = []
-    sinvs = frappe.get_all("Sales Invoice", filters={
-        "status": ["not in", ["Return", "Paid"]],
-        "name": ["not like", "SINV-RET-%"]
-        })
-    for si in sinvs:
-        sinv_numbers.append(str(si["name"]).split("-")[1])
-    return sinv_numbers
+def _get_unpaid_sinv_numbers(sinv_names=None):
+    #Nummern ohne Naming Series Prefix, ggf. aus bereits geladenen Namen abgeleitet
+    if sinv_names is None:
+        sinv_names = _get_unpaid_sinv_names()
+    return [name.split("-")[1] for name in sinv_names]
 
 def _get_unpaid_sinv_names():
-    sinv_numbers = []
     sinvs = frappe.get_all("Sales Invoice", filters={
         "status": ["not in", ["Return", "Paid"]],
         "name": ["not like", "SINV-RET-%"]
-        })
-    for si in sinvs:
-        sinv_numbers.append(str(si["name"]))
-    return sinv_numbers
+        }, pluck="name")
+    return [str(name) for name in sinvs]
 
         
-def _get_sinv_names(zweck, sinvs=None, extended_matching=True):
-    naming_series = get_default_naming_series("Sales Invoice")
+@lru_cache(maxsize=32)
+def _get_naming_series_regex(naming_series):
+    #Regex zur Naming Series nur einmal je Series aufbauen und kompilieren
     if "#" not in naming_series:
         naming_series += "######"
-    regex_naming_series = str(naming_series).replace(".","").replace("#","\\d")
-    match_regex_naming_series =re.findall(regex_naming_series, zweck)
+    return re.compile(str(naming_series).replace(".","").replace("#","\\d"))
+
+def _get_sinv_naming_series_regex():
+    #Standard Naming Series der Rechnungen nur einmal je Request/Job aus den Metadaten ermitteln
+    regex = getattr(frappe.local, "hibiscus_sinv_naming_series_regex", None)
+    if regex is None:
+        regex = _get_naming_series_regex(get_default_naming_series("Sales Invoice"))
+        frappe.local.hibiscus_sinv_naming_series_regex = regex
+    return regex
+
+def _get_sinv_names(zweck, sinvs=None, extended_matching=True):
+    if not zweck:
+        return []
+    regex_naming_series = _get_sinv_naming_series_regex()
+    match_regex_naming_series = regex_naming_series.findall(zweck)
     sinv_name_list = []
     if match_regex_naming_series:
+        #Existenz aller Treffer mit einer Abfrage prüfen statt einzeln je Rechnungsnummer
+        existing = set(frappe.get_all("Sales Invoice", filters={
+            "name": ["in", list(set(match_regex_naming_series))]
+            }, pluck="name"))
         for m in match_regex_naming_series:
             if m not in sinv_name_list:
-                if frappe.db.exists("Sales Invoice", m):
+                if m in existing:
                     sinv_name_list.append(m)
                 else:
                     print(f"Sales Invoice {m} does not exist and will be skipped.")
@@ -369,14 +522,13 @@ def _get_sinv_names(zweck, sinvs=None, extended_matching=True):
 
 
 def _get_grand_totals(sinv_list):
-    grand_total_sum = 0.0
-    for sinv in sinv_list:
-        if frappe.db.exists("Sales Invoice", sinv):
-            sinv_doc = frappe.get_doc("Sales Invoice", sinv)
-            grand_total_sum += sinv_doc.grand_total
-        else:
-            print(f"Sales Invoice {sinv} does not exist and will be skipped.")
-    return round(grand_total_sum, 2)
+    #Summe direkt in der Datenbank bilden, nicht vorhandene Rechnungen zählen nicht mit
+    if not sinv_list:
+        return 0.0
+    grand_total_sum = frappe.db.sql("""
+        SELECT SUM(grand_total) FROM `tabSales Invoice` WHERE name IN %(sinvs)s
+        """, {"sinvs": tuple(sinv_list)})[0][0]
+    return round(flt(grand_total_sum), 2)
 
 
 def make_payment_entry(matching_list, settings=None):
@@ -391,7 +543,7 @@ def make_payment_entry(matching_list, settings=None):
         "party": "", #erstmal leer, wird später anhand vorliegender Rechnungen befüllt
         "party_name": "",
         "paid_from": "",
-        "paid_to":  matching_list["erpnext_bankkonto"].erpnext_bankkonto,
+        "paid_to":  matching_list["erpnext_bankkonto"],
         "paid_amount": matching_list["betrag"],
         "received_amount": matching_list["betrag"],
         "source_exchange_rate": 1,
@@ -402,32 +554,36 @@ def make_payment_entry(matching_list, settings=None):
         "referneces": []
     })
 
-    todo = list(matching_list["sinvs"])
-    todo.extend(x for x in matching_list["sinvs_loose"] if x not in todo)
-    todo.extend(x for x in matching_list["sinvs_cust"] if x not in todo)
-
-    todo.sort()
+    #Rechnungen aller Zuordnungsarten in einem Durchlauf zusammenführen, die Reihenfolge ergibt die Sortierung
+    todo = sorted(set(matching_list["sinvs"]).union(matching_list["sinvs_loose"], matching_list["sinvs_cust"]))
     error = ""
     print(todo)
+    #Benötigte Rechnungsfelder für alle Referenzen mit einer Abfrage laden
+    sinv_data = {}
+    if todo:
+        sinv_data = {si.name: si for si in frappe.get_all("Sales Invoice", filters={
+            "name": ["in", todo]
+            }, fields=["name", "customer", "debit_to", "due_date", "grand_total", "outstanding_amount"])}
     for sinv in todo:
         print("processing " + sinv)
         
-        reference_doc_response = _get_payment_entry_reference(sinv)
+        reference_doc_response = _get_payment_entry_reference(sinv, sinv_data.get(sinv))
+        sinv_doc = reference_doc_response["sinv_doc"]
        
         #Kundennummer setzen wenn bisher leer
         if pe_doc.party == "":
-            pe_doc.party = reference_doc_response["sinv_doc"].customer
-            pe_doc.party_name = frappe.get_value(doctype="Customer", filters={"name": pe_doc.party}, fieldname="customer_name"),
+            pe_doc.party = sinv_doc.customer
+            pe_doc.party_name = frappe.get_cached_value("Customer", pe_doc.party, "customer_name")
         #Fehler, wenn eine bereits befüllte Kundenummer verändert werden soll
-        if pe_doc.party != reference_doc_response["sinv_doc"].customer:
+        if pe_doc.party != sinv_doc.customer:
             error += "Verschiedene Kundenummern in automatisiert zugeordneten Rechnungen.<br>"
             break
 
         #Debitoren Konte anhand Rechnungskonto setzen
         if pe_doc.paid_from == "":
-            pe_doc.paid_from = reference_doc_response["sinv_doc"].debit_to
+            pe_doc.paid_from = sinv_doc.debit_to
         #Fehler, wenn mehrere Debitoren Konten in einem PE angesprochen werden würden
-        if pe_doc.paid_from != reference_doc_response["sinv_doc"].debit_to:
+        if pe_doc.paid_from != sinv_doc.debit_to:
             other_account_sinv.append(sinv)
             continue
         pe_doc.append("references", reference_doc_response["reference_doc"])
@@ -474,8 +630,9 @@ def make_payment_entry(matching_list, settings=None):
     return pe_doc
     
 
-def _get_payment_entry_reference(sinv):
-    sinv_doc = frappe.get_doc("Sales Invoice", sinv)
+def _get_payment_entry_reference(sinv, sinv_doc=None):
+    if sinv_doc is None:
+        sinv_doc = frappe.get_doc("Sales Invoice", sinv)
     reference_doc = frappe.get_doc({ 
         "doctype": "Payment Entry Reference",
         "reference_doctype": "Sales Invoice",
@@ -508,6 +665,7 @@ def set_andere_einnahme(list):
     hbt_list = json.loads(list)
     print(hbt_list)
     for el in hbt_list:
+        #Speichern über das Dokument: Schreibrechte werden geprüft und die Änderung wird versioniert
         hbdoc = frappe.get_doc("Hibiscus Connect Transaction", el)
         hbdoc.status = "andere Einnahme"
         hbdoc.save()
@@ -518,8 +676,8 @@ def dump_checked(list):
 
 def create_debit_charge(sinv, method=None):
     print(sinv.name)
-    settings = frappe.get_single("Hibiscus Connect Settings")
-    if settings.debit_charge_active == 0:
+    #Läuft bei jeder gebuchten Rechnung: ohne aktive Lastschrift nicht das ganze Settings-Dokument laden
+    if not frappe.db.get_single_value("Hibiscus Connect Settings", "debit_charge_active"):
         return
 
     else:
@@ -530,19 +688,21 @@ def create_debit_charge(sinv, method=None):
         payment_terms = invoice.payment_terms_template
         print("payment_terms")
         print(payment_terms)
-        if payment_terms == "SEPA Einzug 7 Tage" or payment_terms == "SEPA Einzug 14 Tage":
+        if payment_terms in SEPA_PAYMENT_TERMS:
             if invoice.grand_total >0:
                 sepa_mandat = frappe.get_all("SEPA Lastschrift Mandat",
                                             filters = {
                                                 "status": "active",
                                                 "customer":customer
                                                 },
-                
+                                            #Für die Auswertung reicht keins/eins/mehrere
+                                            limit = 2,
+                                            pluck = "name"
                                             )
 
                 print(len(sepa_mandat))
                 if len(sepa_mandat) == 1:
-                    sepa_mandat_doc = frappe.get_doc("SEPA Lastschrift Mandat", sepa_mandat[0]["name"])
+                    sepa_mandat_doc = frappe.get_doc("SEPA Lastschrift Mandat", sepa_mandat[0])
                     print(sepa_mandat_doc.frst, sepa_mandat_doc.final)
                     if sepa_mandat_doc.frst == 0 and sepa_mandat_doc.final == 0:
                         sequencetype = "FRST"
@@ -574,7 +734,7 @@ def create_debit_charge(sinv, method=None):
                             }           
                     print(params)
                     
-                    hib = Hibiscus(settings.server, settings.port, settings.get_password("hibiscus_master_password"), settings.ignore_cert)
+                    hib = get_hibiscus_client()
                     deb = hib.get_debit_charge(params)
                     print(deb)
                     if not deb:
@@ -596,33 +756,30 @@ def create_debit_charge(sinv, method=None):
 def set_lagacy_verbucht():
     hib_transactions = frappe.get_all("Hibiscus Connect Transaction", filters={
         "status": "neu"
-    })
+    }, fields=["name", "kommentar"])
     for ht in hib_transactions:
-        ht_doc= frappe.get_doc("Hibiscus Connect Transaction", ht["name"])
-        regex = "PE-\\d\\d\\d\\d\\d"
-        result = re.findall(regex, ht_doc.kommentar)
+        result = LEGACY_PAYMENT_ENTRY_REGEX.findall(ht["kommentar"] or "")
         
         if result:
-            print(ht_doc.kommentar)
+            print(ht["kommentar"])
+            #Nur passende Umsätze laden und über das Dokument speichern, damit die Änderung versioniert wird
+            ht_doc = frappe.get_doc("Hibiscus Connect Transaction", ht["name"])
             ht_doc.status = "legacy verbucht"
             ht_doc.save()
     frappe.db.commit()
 
 @frappe.whitelist()
 def create_bank_account_for_customer(customer, iban, bic):
-    if frappe.get_all("Bank Account", filters={"iban": iban}):
+    if frappe.db.exists("Bank Account", {"iban": iban}):
         return "Bankkonto bereits vorhanden."
     
-    cdoc = frappe.get_doc("Customer", customer)
-    bank = frappe.get_all("Bank", filters={"swift_number": bic})
-    if not bank:
-        bank = create_unknown_bank(bic).name
-    else:
-        bank = bank[0]["name"]
-    len_ges = len(bank) + len(cdoc.customer_name) + len(iban) + 6
+    #Nur der Kundenname wird für den Kontonamen benötigt
+    customer_name = frappe.db.get_value("Customer", customer, "customer_name")
+    bank = _get_bank_for_bic(bic)
+    len_ges = len(bank) + len(customer_name) + len(iban) + 6
 
     str_to = 140 - 6 - len(bank) - len(iban)
-    account_name = cdoc.customer_name[0:str_to] + " | " + iban
+    account_name = customer_name[0:str_to] + " | " + iban
 
     badoc = frappe.get_doc({
         "doctype": "Bank Account",
@@ -636,6 +793,17 @@ def create_bank_account_for_customer(customer, iban, bic):
     badoc.save()
     return "Bankkonto erfolgreich erstellt."
 
+def _get_bank_for_bic(bic):
+    #Bank je BIC für den Request/Job merken, im Sammellauf zahlen viele Kunden über dieselbe Bank
+    banks = getattr(frappe.local, "hibiscus_banks_by_bic", None)
+    if banks is None:
+        banks = frappe.local.hibiscus_banks_by_bic = {}
+    bank = banks.get(bic)
+    if not bank:
+        bank = frappe.db.get_value("Bank", {"swift_number": bic}) or create_unknown_bank(bic).name
+        banks[bic] = bank
+    return bank
+
 def create_unknown_bank(bic):
     bdoc = frappe.get_doc({
         "doctype": "Bank",
@@ -647,11 +815,7 @@ def create_unknown_bank(bic):
 
         
 def dict_to_html_ul(dd, level=0):
-    text = '<ul>'
-    import json
-    for k, v in dd.items():
-        text += '<li><b>%s</b>: %s</li>' % (k, dict_to_html_ul(v, level+1) if isinstance(v, dict) else (json.dumps(v) if isinstance(v, list) else v))
-    text += '</ul>'
-    return text
+    items = ['<li><b>%s</b>: %s</li>' % (k, dict_to_html_ul(v, level+1) if isinstance(v, dict) else (json.dumps(v) if isinstance(v, list) else v)) for k, v in dd.items()]
+    return '<ul>' + ''.join(items) + '</ul>'
 
 